@@ -7,7 +7,13 @@ setup(
     description="Minimal wrapper lib for Python ETLs using Microsoft's Graph API",
     author='glennpai / chglenn20@gmail.com',
     license='MIT',
+    python_requires='>=3.9',
     install_requires=['msal', 'requests'],
+    extras_require={
+        'orjson': ['orjson'],
+        'async': ['aiohttp', 'aiofiles'],
+        'brotli': ['brotli'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest==4.4.1'],
     test_suite='tests',
@@ -0,0 +1,311 @@
+"""
+Module to run high fan-out Python ETL interactions with a SharePoint document library
+on a single asyncio event loop
+"""
+import asyncio
+import contextlib
+import os
+import aiofiles
+import aiohttp
+from urllib3.util.retry import Retry
+from .simpleetl import (COPY_BUFFER_SIZE, LISTING_PAGE_SIZE, RETRY_STATUSES, RETRY_TOTAL,
+    UPLOAD_CHUNK_SIZE, UPLOAD_MAX_RESUMES, advance_upload, item_action_url, next_expected_byte,
+    retry_delay, validate_chunk_size)
+from .tokenprovider import TokenProvider
+
+# Upper bound on in-flight file transfers issued by AsyncSimpleETL.fetch
+ASYNC_MAX_CONCURRENCY = 64
+
+class AsyncSimpleETL:
+    """
+    An asyncio counterpart to SimpleETL that multiplexes many concurrent requests over
+    pooled keep-alive connections on one thread
+
+    Class constructor accepts a DocumentLibrary instance and the required authentication
+    configuration. Instances should be closed with close() or used as an async context
+    manager.
+
+    Attributes:
+        library (DocumentLibrary): SharePoint document library configuration
+        __token_provider [private] (TokenProvider): Acquires and caches the auth token
+        __max_concurrency [private] (int): Upper bound on concurrent file transfers
+        __session [private] (aiohttp.ClientSession): Pooled session, created on first API use
+    """
+    def __init__(self, document_library, thumbprint, private_key,
+                 token_cache_path=None, max_concurrency=ASYNC_MAX_CONCURRENCY):
+        self.library = document_library
+        self.__token_provider = TokenProvider(document_library, thumbprint, private_key,
+            token_cache_path)
+        self.__max_concurrency = max_concurrency
+        self.__session = None
+
+
+    async def __aenter__(self):
+        self.__get_session()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+
+    async def close(self):
+        """
+        Closes the pooled session and its open connections
+
+        Parameters:
+        Returns:
+        """
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+
+    def __get_session(self):
+        """
+        Gets the pooled session, creating it on first use. This is deliberately not a
+        coroutine: with no await between the check and the assignment, concurrent first
+        calls on the event loop cannot each build their own session
+
+        Parameters:
+        Returns:
+            session (aiohttp.ClientSession): Pooled session shared by all calls
+        """
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300))
+        return self.__session
+
+
+    async def __auth_headers(self):
+        """
+        Gets the Authorization header for Graph API calls, refreshing the auth token off
+        the event loop when it is near expiry
+
+        Parameters:
+        Returns:
+            headers (dict): Authorization header
+        """
+        token = await asyncio.to_thread(self.__token_provider.get_token)
+        return {'Authorization': 'Bearer ' + token}
+
+
+    @contextlib.asynccontextmanager
+    async def __request(self, method, url, authorize=False, headers=None, **kwargs):
+        """
+        Sends a request, retrying throttled or failing responses on idempotent methods
+        with exponential backoff that honours the Retry-After header, as the synchronous
+        client's session adapter does
+
+        Parameters:
+            method (string): HTTP method
+            url (string): Request URL
+            authorize (bool): Whether to send the Graph API Authorization header
+            headers (dict): Additional request headers
+            kwargs: Passed through to aiohttp.ClientSession.request
+        Returns:
+            response (aiohttp.ClientResponse): Final response, released on exit
+        """
+        session = self.__get_session()
+        retries = RETRY_TOTAL if method in Retry.DEFAULT_ALLOWED_METHODS else 0
+        for attempt in range(retries + 1):
+            request_headers = dict(headers or {})
+            if authorize:
+                request_headers.update(await self.__auth_headers())
+            response = await session.request(method, url, headers=request_headers, **kwargs)
+            if response.status not in RETRY_STATUSES or attempt == retries:
+                break
+            delay = retry_delay(response.headers.get('Retry-After'), attempt)
+            response.release()
+            await asyncio.sleep(delay)
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+
+    async def __list_children(self, remote_path, fields):
+        """
+        Gets the child items of the remote_path directory, selecting only the given fields
+        and following pagination links until every page is read
+
+        Parameters:
+            remote_path (string): Path to parent directory containing target files
+            fields (string): Comma separated DriveItem fields to select
+        Returns:
+            items (dict[]): Child items of the remote_path directory
+        """
+        items = []
+        next_url = (f'{self.library.base_url}/root:/{remote_path}:/children'
+            f'?$select={fields}&$top={LISTING_PAGE_SIZE}')
+        while next_url:
+            async with self.__request('GET', next_url, authorize=True) as file_list_resp:
+                if file_list_resp.status != 200:
+                    raise Exception(f'Failed to fetch file list from {remote_path}. \
+                        Status {file_list_resp.status}')
+                page = await file_list_resp.json()
+            items.extend(page['value'])
+            next_url = page.get('@odata.nextLink')
+
+        return items
+
+
+    async def __download_file(self, semaphore, url, out_path):
+        """
+        Streams a single file from a pre-signed download URL to a local path
+
+        Parameters:
+            semaphore (asyncio.Semaphore): Bounds the number of concurrent transfers
+            url (string): Pre-signed download URL of the remote file
+            out_path (string): Local path where the file will be written
+        Returns:
+        """
+        async with semaphore, self.__request('GET', url) as file_data:
+            if file_data.status != 200:
+                raise Exception(f'Bad response fetching file "{os.path.basename(out_path)}". \
+                    Status {file_data.status}')
+            try:
+                async with aiofiles.open(out_path, 'wb') as file:
+                    async for chunk in file_data.content.iter_chunked(COPY_BUFFER_SIZE):
+                        await file.write(chunk)
+            except Exception as err:
+                raise Exception(f'Failed to write file data. {err}') from err
+
+
+    async def filenames(self, remote_path):
+        """
+        Gets a list of file names that are children to the remote_path directory
+        Useful for checking existence of a remote file
+
+        Parameters:
+            remote_path (string): Path to parent directory containing target files
+        Returns:
+            filenames (string[]): List of file names in the remote_path directory
+        """
+        objs = await self.__list_children(remote_path, 'name,file')
+        return [obj['name'] for obj in objs if obj.get('file')]
+
+
+    async def fetch(self, remote_path, local_path='.'):
+        """
+        Creates a local copy of files contained in the document library at the remote_path
+
+        Parameters:
+            remote_path (string): Path to parent directory containing target files
+            local_path (string): Path to local directory where files will be written - Default '.'
+        Returns:
+        """
+        objs = await self.__list_children(remote_path, 'name,file,@microsoft.graph.downloadUrl')
+        clean_path = local_path.strip('/\\')
+        os.makedirs(clean_path, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.__max_concurrency)
+        tasks = [asyncio.ensure_future(self.__download_file(semaphore,
+            obj['@microsoft.graph.downloadUrl'], os.path.join(clean_path, obj['name'])))
+            for obj in objs if obj.get('file')]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop sibling downloads before the session can be closed underneath them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+    async def delete(self, remote_path, file_name):
+        """
+        Deletes a remote file from a SharePoint document library based on file path
+        and name
+
+        Parameters:
+            remote_path (string): Remote path of parent directory of file to delete
+            file_name (string): Name of remote file to delete
+        Returns:
+        """
+        objs = await self.__list_children(remote_path, 'id,name')
+        item_id = next((obj['id'] for obj in objs if obj['name'] == file_name), '')
+        if item_id == '':
+            raise Exception(f'Failed to fetch item info for {file_name}')
+
+        async with self.__request('DELETE', f'{self.library.base_url}/items/{item_id}',
+                authorize=True) as delete_response:
+            if delete_response.status != 204:
+                raise Exception(f'Failed to delete {file_name}. Status {delete_response.status}')
+
+
+    async def upload(self, file_name, remote_path, local_path='.', chunk_size=UPLOAD_CHUNK_SIZE):
+        """
+        Uploads a local file to a SharePoint document library at a specified remote_path
+        in sequential byte ranges through an upload session
+
+        Parameters:
+            local_file (string): Local file name and format
+            remote_path (string): Remote path of parent directory of file to upload
+            local_path (string): Local path to file - Default '.'
+            chunk_size (int): Bytes sent per request, a multiple of 320 KiB - Default 3200 KiB
+        Returns:
+        """
+        validate_chunk_size(chunk_size)
+
+        full_local = os.path.join(local_path, file_name)
+        async with aiofiles.open(full_local, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if file_size == 0:
+                async with self.__request('PUT',
+                        item_action_url(self.library.base_url, remote_path, file_name, 'content'),
+                        authorize=True, data=b'') as upload_response:
+                    if upload_response.status not in (200, 201):
+                        raise Exception(f'Failed to upload empty file {file_name}. \
+                            Status {upload_response.status}')
+                return
+
+            async with self.__request('POST', item_action_url(self.library.base_url,
+                    remote_path, file_name, 'createUploadSession'),
+                    authorize=True) as upload_session:
+                if upload_session.status != 200:
+                    raise Exception(f'Error retrieving upload URL. Status {upload_session.status}')
+                upload_url = (await upload_session.json())['uploadUrl']
+
+            await self.__upload_chunks(upload_url, file, file_size, chunk_size)
+
+
+    async def __upload_chunks(self, upload_url, file, file_size, chunk_size):
+        """
+        Sends file data to an upload session one byte range at a time, resuming from the
+        session's next expected range when the service rejects a chunk
+
+        Parameters:
+            upload_url (string): Pre-signed upload session URL
+            file (aiofiles file): Open binary file to upload
+            file_size (int): Total size of the file in bytes
+            chunk_size (int): Bytes sent per request
+        Returns:
+        """
+        start = 0
+        resumes = 0
+        while start < file_size:
+            await file.seek(start)
+            chunk = await file.read(chunk_size)
+            end = start + len(chunk) - 1
+            # Content length and content range are required headers.
+            async with self.__request('PUT', upload_url,
+                    headers={'Content-Length': f'{len(chunk)}',
+                    'Content-Range': f'bytes {start}-{end}/{file_size}'},
+                    data=chunk) as chunk_response:
+                if chunk_response.status in (200, 201):
+                    return
+                if chunk_response.status == 202:
+                    start, resumes = advance_upload(start,
+                        next_expected_byte(await chunk_response.json(), end + 1), resumes)
+                    continue
+                if chunk_response.status not in (404, 409, 416) or resumes >= UPLOAD_MAX_RESUMES:
+                    raise Exception(f'Failed to upload bytes {start}-{end}. \
+                        Status {chunk_response.status}')
+
+            resumes += 1
+            async with self.__request('GET', upload_url) as status_response:
+                if status_response.status != 200:
+                    raise Exception(f'Failed to query upload session status. \
+                        Status {status_response.status}')
+                start = next_expected_byte(await status_response.json(), start)
@@ -2,9 +2,132 @@
 Module to simplify basic Python ETL interactions with a SharePoint document library
 """
 import os
-import re
-import msal
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests
+try:
+    import orjson
+except ImportError:
+    # json.loads accepts bytes too, so it stands in for orjson.loads when not installed
+    import json as orjson
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+from .tokenprovider import TokenProvider
+
+# Retries on throttled or failing responses, with exponential backoff between attempts
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.2
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Concurrent file downloads issued by SimpleETL.fetch
+DOWNLOAD_WORKERS = 16
+# Buffer size used when streaming file bodies to disk
+COPY_BUFFER_SIZE = 1 << 20
+# Graph JSON batching endpoint and its per-call sub-request limit
+BATCH_URL = 'https://graph.microsoft.com/v1.0/$batch'
+BATCH_LIMIT = 20
+# Upload session byte ranges must be multiples of 320 KiB
+UPLOAD_CHUNK_ALIGNMENT = 327680
+UPLOAD_CHUNK_SIZE = 10 * UPLOAD_CHUNK_ALIGNMENT
+# Times an upload resumes from the session's next expected range before giving up
+UPLOAD_MAX_RESUMES = 3
+# Items requested per page when listing a directory's children
+LISTING_PAGE_SIZE = 999
+# Seconds a directory's name to item ID listing is reused by delete calls
+LISTING_CACHE_TTL = 30
+
+def retry_delay(retry_after, attempt):
+    """
+    Gets the seconds to wait before retrying a throttled or failing response, preferring
+    its Retry-After header over exponential backoff
+
+    Parameters:
+        retry_after (string): Retry-After header value, in seconds or as an HTTP date, or None
+        attempt (int): Zero-based number of the attempt that produced the response
+    Returns:
+        delay (float): Seconds to wait before the next attempt
+    """
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return RETRY_BACKOFF_FACTOR * 2 ** attempt
+
+
+def validate_chunk_size(chunk_size):
+    """
+    Raises if chunk_size is not a positive multiple of UPLOAD_CHUNK_ALIGNMENT, as upload
+    sessions require
+
+    Parameters:
+        chunk_size (int): Bytes sent per upload request
+    Returns:
+    """
+    if chunk_size <= 0 or chunk_size % UPLOAD_CHUNK_ALIGNMENT != 0:
+        raise Exception(f'Chunk size must be a positive multiple of {UPLOAD_CHUNK_ALIGNMENT}')
+
+
+def next_expected_byte(session_status, default):
+    """
+    Gets the first byte of the earliest range an upload session still expects
+
+    Parameters:
+        session_status (dict): Upload session status returned by the service
+        default (int): Byte offset used when the status lists no expected ranges
+    Returns:
+        start (int): Byte offset of the next chunk to send
+    """
+    ranges = session_status.get('nextExpectedRanges')
+    if not ranges:
+        return default
+    return int(ranges[0].split('-')[0])
+
+
+def advance_upload(start, next_start, resumes):
+    """
+    Moves an upload to the next range the session expects after a 202 response, counting
+    a range that does not advance past start against UPLOAD_MAX_RESUMES
+
+    Parameters:
+        start (int): First byte of the range just sent
+        next_start (int): First byte of the range the session expects next
+        resumes (int): Resumes used so far by the upload
+    Returns:
+        next_start (int): Byte offset of the next chunk to send
+        resumes (int): Resumes used so far, including this one if the upload stalled
+    """
+    if next_start <= start:
+        resumes += 1
+        if resumes > UPLOAD_MAX_RESUMES:
+            raise Exception(f'Upload session stopped advancing at byte {start}')
+    return next_start, resumes
+
+
+def item_action_url(base_url, remote_path, file_name, action):
+    """
+    Builds the URL of an action on a drive item addressed by path, such as content or
+    createUploadSession. Upload sessions reject empty byte ranges, so empty files are
+    created through the content action instead
+
+    Parameters:
+        base_url (string): Base URL of the document library
+        remote_path (string): Remote path of parent directory of the item
+        file_name (string): Name of the item
+        action (string): Item action to address
+    Returns:
+        url (string): Action URL
+    """
+    return f'{base_url}/root:/{remote_path}/{file_name}:/{action}'
+
 
 class SimpleETL:
     """
@@ -16,62 +139,240 @@ class SimpleETL:
 
     Attributes:
         library (DocumentLibrary): SharePoint document library configuration
-        __thumbprint [private] (string): Hash of signed certificate used when authenticating to the
-            Azure app registration
-        __private_key [private] (string): Private key used to authenticate to the Azure app
-            registration
-        __token [private] (string): Authentication token acquired from Azure app registration
+        __token_provider [private] (TokenProvider): Acquires and caches the auth token, lazily
+            on first API use
+        __item_id_cache [private] (dict): Mapping of remote path to (expiry, {name: item ID})
+            for recently listed directories
+        _session (requests.Session): Pooled keep-alive session for authenticated Graph API calls
+        _transfer_session (requests.Session): Pooled keep-alive session for pre-signed download
+            and upload URLs, which must not carry the Authorization header
     """
-    def __init__(self, document_library, thumbprint, private_key):
+    def __init__(self, document_library, thumbprint, private_key,
+                 token_cache_path=None):
         self.library = document_library
-        self.__thumbprint = thumbprint
-        self.__private_key = private_key
-        self.__token = self.__acquire_token()
+        self.__token_provider = TokenProvider(document_library, thumbprint, private_key,
+            token_cache_path)
+        self.__item_id_cache = {}
+        self.__api_session = self.__build_session()
+        self._transfer_session = self.__build_session()
+
+
+    @property
+    def _session(self):
+        """
+        Authenticated Graph API session, refreshing its auth token when near expiry
+
+        Parameters:
+        Returns:
+            session (requests.Session): Session carrying the Authorization header
+        """
+        self.__api_session.headers['Authorization'] = 'Bearer ' + self.__token_provider.get_token()
+        return self.__api_session
 
 
     @staticmethod
-    def __get_item_id(file_items, target_name):
+    def __build_session():
+        """
+        Builds a requests session with connection pooling and retry on transient errors
+        so consecutive calls reuse open TLS connections
+
+        Parameters:
+        Returns:
+            session (requests.Session): Configured session
+        """
+        # The default Accept-Encoding advertises br alongside gzip when the optional
+        # brotli package is installed, so large listings are compressed on the wire
+        session = requests.Session()
+        retries = Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES)
+        session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=40,
+            max_retries=retries))
+        return session
+
+
+    def __get_item_ids(self, remote_path):
         """
-        Gets item ID value from a file object if its name matches the target name
+        Gets a mapping of child names to item IDs for the remote_path directory, reusing
+        a cached listing until it expires
 
         Parameters:
-            file_items (any[]): List of file objects to check
-            target_name (string): Name to search for in list of file objects
+            remote_path (string): Path to parent directory containing target files
         Returns:
-            item_id (string): Item ID property value
+            item_ids (dict): Mapping of child item names to item ID values
         """
-        item_id = ''
+        cached = self.__item_id_cache.get(remote_path)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
 
-        for item in file_items:
-            if item['name'] == target_name:
-                item_id = item['id']
+        item_ids = {item['name']: item['id']
+            for item in self.__list_children(remote_path, 'id,name')}
+        self.__item_id_cache[remote_path] = (time.monotonic() + LISTING_CACHE_TTL, item_ids)
+        return item_ids
 
-        return item_id
 
+    def __list_children(self, remote_path, fields):
+        """
+        Gets the child items of the remote_path directory, selecting only the given fields
+        and following pagination links until every page is read
 
-    def __acquire_token(self):
+        Parameters:
+            remote_path (string): Path to parent directory containing target files
+            fields (string): Comma separated DriveItem fields to select
+        Returns:
+            items (dict[]): Child items of the remote_path directory
         """
-        Authenticates against Azure app registration to get an auth token used for
-        calls to the Graph API
+        list_url = (f'{self.library.base_url}/root:/{remote_path}:/children'
+            f'?$select={fields}&$top={LISTING_PAGE_SIZE}')
+        return self.__follow_pages(remote_path, {'@odata.nextLink': list_url})
+
+
+    def __follow_pages(self, remote_path, page):
+        """
+        Collects the items of a listing page and every page after it
 
         Parameters:
+            remote_path (string): Path to the listed directory, used in error messages
+            page (dict): Parsed listing page, possibly holding value and @odata.nextLink keys
         Returns:
-            result['access_token'] (string): String value of auth token
+            items (dict[]): Items from the page and all following pages
         """
-        app = msal.ConfidentialClientApplication(
-            self.library.client_id,
-            authority=self.library.authority,
-            client_credential={'thumbprint': self.__thumbprint, 'private_key': self.__private_key},
-        )
-        result = None
-        result = app.acquire_token_silent([self.library.scope], account=None)
+        items = list(page.get('value', []))
+        next_url = page.get('@odata.nextLink')
+        while next_url:
+            file_list_resp = self._session.get(next_url)
+            if file_list_resp.status_code != 200:
+                raise Exception(f'Failed to fetch file list from {remote_path}. \
+                    {file_list_resp.raise_for_status()}')
+            page = orjson.loads(file_list_resp.content)
+            items.extend(page['value'])
+            next_url = page.get('@odata.nextLink')
 
-        if not result:
-            result = app.acquire_token_for_client(scopes=[self.library.scope])
-        if 'access_token' in result:
-            return result['access_token']
+        return items
 
-        raise Exception(result.get('error'))
+
+    @staticmethod
+    def __download_file(session, url, out_path):
+        """
+        Streams a single file from a pre-signed download URL to a local path
+
+        Parameters:
+            session (requests.Session): Session used to issue the download request
+            url (string): Pre-signed download URL of the remote file
+            out_path (string): Local path where the file will be written
+        Returns:
+        """
+        with session.get(url, stream=True) as file_data:
+            if file_data.status_code != 200:
+                raise Exception(f'Bad response fetching file "{os.path.basename(out_path)}".' +
+                    f'{file_data.raise_for_status()}')
+            # Undo any transfer Content-Encoding since the raw stream is read directly
+            file_data.raw.decode_content = True
+            try:
+                with open(out_path, 'wb') as file:
+                    shutil.copyfileobj(file_data.raw, file, length=COPY_BUFFER_SIZE)
+            except Exception as err:
+                raise Exception(f'Failed to write file data. {err}') from err
+
+
+    def __upload_chunks(self, upload_url, file, file_size, chunk_size):
+        """
+        Sends file data to an upload session one byte range at a time, resuming from the
+        session's next expected range when the service rejects a chunk
+
+        Parameters:
+            upload_url (string): Pre-signed upload session URL
+            file (file): Open binary file to upload
+            file_size (int): Total size of the file in bytes
+            chunk_size (int): Bytes sent per request
+        Returns:
+        """
+        start = 0
+        resumes = 0
+        while start < file_size:
+            file.seek(start)
+            chunk = file.read(chunk_size)
+            end = start + len(chunk) - 1
+            # Content length and content range are required headers.
+            # Each range is sent as one bytes body, which urllib3 hands to the socket in a
+            # single sendall rather than in small file reads. A generator body would instead be
+            # streamed with Transfer-Encoding: chunked, which upload sessions reject because
+            # they require Content-Length.
+            # Transient 429/5xx responses are retried by the session adapter.
+            chunk_response = self._transfer_session.put(upload_url,
+                headers={'Content-Length': f'{len(chunk)}',
+                'Content-Range': f'bytes {start}-{end}/{file_size}'},
+                data=chunk)
+
+            if chunk_response.status_code in (200, 201):
+                return
+            if chunk_response.status_code == 202:
+                start, resumes = advance_upload(start,
+                    next_expected_byte(chunk_response.json(), end + 1), resumes)
+            elif chunk_response.status_code in (404, 409, 416) and resumes < UPLOAD_MAX_RESUMES:
+                resumes += 1
+                status_response = self._transfer_session.get(upload_url)
+                if status_response.status_code != 200:
+                    raise Exception(f'Failed to query upload session status. \
+                        {status_response.raise_for_status()}')
+                start = next_expected_byte(status_response.json(), start)
+            else:
+                raise Exception(f'Failed to upload bytes {start}-{end}. \
+                    {chunk_response.raise_for_status()}')
+
+
+    def __upload_empty(self, remote_path, file_name):
+        """
+        Creates an empty remote file with a single content PUT
+
+        Parameters:
+            remote_path (string): Remote path of parent directory of file to upload
+            file_name (string): Name of remote file to create
+        Returns:
+        """
+        upload_response = self._session.put(
+            item_action_url(self.library.base_url, remote_path, file_name, 'content'), data=b'')
+        if upload_response.status_code not in (200, 201):
+            raise Exception(f'Failed to upload empty file {file_name}. \
+                {upload_response.raise_for_status()}')
+
+
+    def __batch(self, sub_requests):
+        """
+        Sends sub-requests through the Graph JSON batching endpoint, packing up to
+        BATCH_LIMIT sub-requests per HTTP call and re-sending throttled or failing
+        sub-requests up to RETRY_TOTAL times
+
+        Parameters:
+            sub_requests (dict[]): Batch sub-requests with method and relative url keys
+        Returns:
+            responses (dict[]): Batch sub-responses in the same order as sub_requests
+        """
+        responses = [None] * len(sub_requests)
+        pending = list(range(len(sub_requests)))
+        for attempt in range(RETRY_TOTAL + 1):
+            retry, delay = [], 0.0
+            for start in range(0, len(pending), BATCH_LIMIT):
+                batch_body = {'requests': [dict(sub_requests[index], id=str(index))
+                    for index in pending[start:start + BATCH_LIMIT]]}
+                batch_response = self._session.post(BATCH_URL, json=batch_body)
+                if batch_response.status_code != 200:
+                    raise Exception(f'Bad response from the batch endpoint. \
+                        {batch_response.raise_for_status()}')
+                for response in orjson.loads(batch_response.content)['responses']:
+                    index = int(response['id'])
+                    responses[index] = response
+                    # The batch call itself succeeds, so throttled sub-requests are not
+                    # retried by the session adapter and are re-sent here instead
+                    if response['status'] in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                        headers = CaseInsensitiveDict(response.get('headers'))
+                        retry.append(index)
+                        delay = max(delay, retry_delay(headers.get('Retry-After'), attempt))
+            if not retry:
+                break
+            time.sleep(delay)
+            pending = sorted(retry)
+
+        return responses
 
 
     def filenames(self, remote_path):
@@ -84,18 +385,33 @@ class SimpleETL:
         Returns:
             filenames (string[]): List of file names in the remote_path directory
         """
-        filenames = []
-        file_list_resp = requests.get(f'{self.library.base_url}/root:/{remote_path}:/children',
-                                headers={'Authorization': 'Bearer ' + self.__token})
+        objs = self.__list_children(remote_path, 'name,file')
+        return [obj['name'] for obj in objs if obj.get('file')]
 
-        if file_list_resp.status_code == 200:
-            objs = file_list_resp.json()['value']
-            for obj in objs:
-                if obj['file']:
-                    filenames.append(obj['name'])
-        else:
-            raise Exception('Bad response from the remote host.' +
-                f'{file_list_resp.raise_for_status()}')
+
+    def filenames_many(self, remote_paths):
+        """
+        Gets the file names that are children to each of the remote_paths directories
+        using batched requests
+
+        Parameters:
+            remote_paths (string[]): Paths to parent directories containing target files
+        Returns:
+            filenames (dict): Mapping of each remote path to its list of file names
+        """
+        drive_path = f'/sites/{self.library.site_id}/drives/{self.library.res_id}'
+        responses = self.__batch([{'method': 'GET',
+            'url': f'{drive_path}/root:/{remote_path}:/children'
+                f'?$select=name,file&$top={LISTING_PAGE_SIZE}'}
+            for remote_path in remote_paths])
+
+        filenames = {}
+        for remote_path, response in zip(remote_paths, responses):
+            if response['status'] != 200:
+                raise Exception(f'Failed to fetch file list from {remote_path}. \
+                    Status {response["status"]}')
+            objs = self.__follow_pages(remote_path, response['body'])
+            filenames[remote_path] = [obj['name'] for obj in objs if obj.get('file')]
 
         return filenames
 
@@ -109,29 +425,54 @@ class SimpleETL:
             local_path (string): Path to local directory where files will be written - Default '.'
         Returns:
         """
-        file_list_resp = requests.get(f'{self.library.base_url}/root:/{remote_path}:/children',
-                                headers={'Authorization': 'Bearer ' + self.__token})
-        if file_list_resp.status_code == 200:
-            objs = file_list_resp.json()['value']
-            for obj in objs:
-                if not obj['file']:
-                    continue
-                file_data = requests.get(obj['@microsoft.graph.downloadUrl'])
-                if file_data.status_code == 200:
-                    try:
-                        clean_path = re.sub(r'^(\\|\/)+|(\\|\/)+$', '', local_path)
-                        if not os.path.exists(clean_path):
-                            os.makedirs(clean_path)
-                        with open(os.path.join(clean_path, obj['name']), 'wb') as file:
-                            file.write(file_data.content)
-                    except Exception as err:
-                        raise f'Failed to write file data. {err}'
-                else:
-                    raise Exception(f'Bad response fetching file "{obj["name"]}".' +
-                        f'{file_data.raise_for_status()}')
-        else:
-            raise Exception('Bad response from the remote host.' +
-                f'{file_list_resp.raise_for_status()}')
+        objs = self.__list_children(remote_path, 'name,file,@microsoft.graph.downloadUrl')
+        clean_path = local_path.strip('/\\')
+        os.makedirs(clean_path, exist_ok=True)
+        downloads = [(obj['@microsoft.graph.downloadUrl'], os.path.join(clean_path, obj['name']))
+            for obj in objs if obj.get('file')]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(self.__download_file, self._transfer_session, url, out_path)
+                for url, out_path in downloads]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                # Drop queued downloads so the error surfaces without waiting on them
+                executor.shutdown(cancel_futures=True)
+                raise
+
+
+    def delete_many(self, remote_path, file_names):
+        """
+        Deletes remote files from a SharePoint document library based on file path
+        and names using batched requests
+
+        Parameters:
+            remote_path (string): Remote path of parent directory of files to delete
+            file_names (string[]): Names of remote files to delete
+        Returns:
+        """
+        listing = self.__get_item_ids(remote_path)
+        item_ids = []
+        for file_name in file_names:
+            item_id = listing.get(file_name, '')
+            if item_id == '':
+                raise Exception(f'Failed to fetch item info for {file_name}')
+            item_ids.append(item_id)
+
+        drive_path = f'/sites/{self.library.site_id}/drives/{self.library.res_id}'
+        try:
+            responses = self.__batch([{'method': 'DELETE', 'url': f'{drive_path}/items/{item_id}'}
+                for item_id in item_ids])
+        except Exception:
+            self.__item_id_cache.pop(remote_path, None)
+            raise
+        for file_name, response in zip(file_names, responses):
+            if response['status'] != 204:
+                self.__item_id_cache.pop(remote_path, None)
+                raise Exception(f'Failed to delete {file_name}. Status {response["status"]}')
+            # Keep the cached listing valid for further deletes in the same directory
+            listing.pop(file_name, None)
 
 
     def delete(self, remote_path, file_name):
@@ -144,55 +485,38 @@ class SimpleETL:
             file_name (string): Name of remote file to delete
         Returns:
         """
-        list_url = f'{self.library.base_url}/root:/{remote_path}:/children'
-        file_list_response = requests.get(list_url,
-            headers={'Authorization': 'Bearer ' + self.__token})
-
-        if file_list_response.status_code == 200:
-            item_id = self.__get_item_id(file_list_response.json()['value'], file_name)
-            if item_id != '':
-                delete_url = f'{self.library.base_url}/items/'
-                delete_response = requests.delete(delete_url + item_id,
-                    headers={'Authorization': 'Bearer ' + self.__token})
-                if delete_response.status_code != 204:
-                    raise Exception(f'Failed to delete {file_name}. \
-                        {delete_response.raise_for_status()}')
-            else:
-                raise Exception(f'Failed to fetch item info for {file_name}')
-        else:
-            raise Exception(f'Failed to fetch file list from {remote_path}. \
-                {file_list_response.raise_for_status()}')
+        self.delete_many(remote_path, [file_name])
 
 
-    def upload(self, file_name, remote_path, local_path='.'):
+    def upload(self, file_name, remote_path, local_path='.', chunk_size=UPLOAD_CHUNK_SIZE):
         """
         Uploads a local file to a SharePoint document library at a specified remote_path
+        in sequential byte ranges through a resumable upload session
 
         Parameters:
             local_file (string): Local file name and format
             remote_path (string): Remote path of parent directory of file to upload
             local_path (string): Local path to file - Default '.'
+            chunk_size (int): Bytes sent per request, a multiple of 320 KiB - Default 3200 KiB
         Returns:
         """
-        upload_session = requests.post(f'{self.library.base_url}/root:/ \
-            {remote_path}/{file_name}:/createUploadSession',
-            headers={'Authorization': 'Bearer ' + self.__token})
+        validate_chunk_size(chunk_size)
 
-        if upload_session.status_code == 200:
-            upload_url = upload_session.json()['uploadUrl']
-            try:
-                full_local = os.path.join(local_path, file_name)
-                with open(full_local, 'rb') as file:
-                    file_size = os.path.getsize(full_local)
-                    # Content length and content range are required headers.
-                    # File data (bytes) is sent in body.
-                    upload_response = requests.put(upload_url,
-                        headers={'Content-Length': f'{file_size}',
-                        'Content-Range': f'bytes 0-{file_size - 1}/{file_size}'},
-                        data=file)
-                    if upload_response.status_code != 201:
-                        raise Exception(upload_response.raise_for_status())
-            except Exception as err:
-                raise f'Failed to upload file to upload URL. {err}'
-        else:
-            raise Exception(f'Error retrieving upload URL. {upload_session.raise_for_status()}')
+        full_local = os.path.join(local_path, file_name)
+        with open(full_local, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if file_size == 0:
+                self.__upload_empty(remote_path, file_name)
+            else:
+                upload_session = self._session.post(item_action_url(self.library.base_url,
+                    remote_path, file_name, 'createUploadSession'))
+
+                if upload_session.status_code != 200:
+                    raise Exception(f'Error retrieving upload URL. \
+                        {upload_session.raise_for_status()}')
+                upload_url = upload_session.json()['uploadUrl']
+                try:
+                    self.__upload_chunks(upload_url, file, file_size, chunk_size)
+                except Exception as err:
+                    raise Exception(f'Failed to upload file to upload URL. {err}') from err
+        self.__item_id_cache.pop(remote_path, None)
@@ -0,0 +1,136 @@
+"""
+Module to acquire and cache Graph API auth tokens for an Azure app registration
+"""
+import contextlib
+import os
+import threading
+import time
+import msal
+
+# Seconds before expiry at which a cached auth token is re-acquired
+TOKEN_REFRESH_MARGIN = 300
+# Suggested on-disk location of the serialized MSAL token cache, when persistence is opted into
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.simple_graph_etl', 'token.bin')
+
+class TokenProvider:
+    """
+    A class to acquire auth tokens from an Azure app registration, reusing a token until it
+    nears expiry. Shared by the synchronous and asyncio ETL clients.
+
+    Attributes:
+        library (DocumentLibrary): SharePoint document library configuration
+        __thumbprint [private] (string): Hash of signed certificate used when authenticating to the
+            Azure app registration
+        __private_key [private] (string): Private key used to authenticate to the Azure app
+            registration
+        __token_cache_path [private] (string): Path of the persisted MSAL token cache, or None
+            to keep the cache in memory only. Persistence is best-effort: a cache that cannot
+            be read or written is ignored
+        __token [private] (string): Authentication token acquired from Azure app registration
+        __token_expires_at [private] (float): Monotonic time at which __token expires
+        __token_lock [private] (threading.Lock): Serializes token acquisition across threads
+        __app [private] (msal.ConfidentialClientApplication): MSAL client, built on first use
+        __cache [private] (msal.SerializableTokenCache): MSAL token cache backing __app
+    """
+    def __init__(self, document_library, thumbprint, private_key, token_cache_path=None):
+        self.library = document_library
+        self.__thumbprint = thumbprint
+        self.__private_key = private_key
+        self.__token_cache_path = token_cache_path
+        self.__token = None
+        self.__token_expires_at = 0.0
+        self.__token_lock = threading.Lock()
+        self.__app = None
+        self.__cache = None
+
+
+    def get_token(self):
+        """
+        Gets the auth token for the Graph API, acquiring it on first use and again once it
+        is within TOKEN_REFRESH_MARGIN seconds of expiring
+
+        Parameters:
+        Returns:
+            __token (string): String value of auth token
+        """
+        with self.__token_lock:
+            if self.__token is None or \
+                    time.monotonic() >= self.__token_expires_at - TOKEN_REFRESH_MARGIN:
+                acquired_at = time.monotonic()
+                self.__token, expires_in = self.__acquire_token()
+                self.__token_expires_at = acquired_at + expires_in
+            return self.__token
+
+
+    def __acquire_token(self):
+        """
+        Authenticates against Azure app registration to get an auth token used for
+        calls to the Graph API
+
+        Parameters:
+        Returns:
+            result['access_token'] (string): String value of auth token
+            result['expires_in'] (int): Seconds until the auth token expires
+        """
+        if self.__app is None:
+            self.__cache = msal.SerializableTokenCache()
+            if self.__token_cache_path:
+                self.__load_token_cache(self.__cache)
+
+            self.__app = msal.ConfidentialClientApplication(
+                self.library.client_id,
+                authority=self.library.authority,
+                client_credential={'thumbprint': self.__thumbprint,
+                    'private_key': self.__private_key},
+                token_cache=self.__cache,
+            )
+        result = self.__app.acquire_token_silent([self.library.scope], account=None)
+
+        if not result:
+            result = self.__app.acquire_token_for_client(scopes=[self.library.scope])
+        if self.__token_cache_path and self.__cache.has_state_changed:
+            self.__save_token_cache(self.__cache)
+            self.__cache.has_state_changed = False
+        if 'access_token' in result:
+            return result['access_token'], int(result['expires_in'])
+
+        raise Exception(result.get('error'))
+
+
+    def __load_token_cache(self, cache):
+        """
+        Loads the serialized token cache from the configured path, leaving the cache empty
+        when the file is missing, unreadable or corrupt
+
+        Parameters:
+            cache (msal.SerializableTokenCache): Token cache to populate
+        Returns:
+        """
+        try:
+            with open(self.__token_cache_path, 'r', encoding='utf-8') as cache_file:
+                cache.deserialize(cache_file.read())
+        except (OSError, ValueError):
+            pass
+
+
+    def __save_token_cache(self, cache):
+        """
+        Atomically writes the serialized token cache to the configured path, readable
+        only by the current user. Failures are ignored since the token is already in hand
+
+        Parameters:
+            cache (msal.SerializableTokenCache): Token cache to persist
+        Returns:
+        """
+        tmp_path = f'{self.__token_cache_path}.{os.getpid()}.tmp'
+        try:
+            cache_dir = os.path.dirname(self.__token_cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(cache.serialize())
+            os.replace(tmp_path, self.__token_cache_path)
+        except (OSError, ValueError):
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
@@ -0,0 +1,549 @@
+"""
+Tests for SimpleETL against mocked Graph API sessions
+"""
+import asyncio
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from simple_graph_etl.documentlibrary import DocumentLibrary
+from simple_graph_etl.simpleetl import (BATCH_LIMIT, RETRY_BACKOFF_FACTOR, RETRY_TOTAL,
+    UPLOAD_CHUNK_ALIGNMENT, UPLOAD_MAX_RESUMES, SimpleETL)
+from simple_graph_etl.tokenprovider import TOKEN_REFRESH_MARGIN, TokenProvider
+try:
+    from simple_graph_etl.asyncsimpleetl import AsyncSimpleETL
+except ImportError:
+    # The async client needs the optional aiohttp and aiofiles packages
+    AsyncSimpleETL = None
+
+CHUNK = UPLOAD_CHUNK_ALIGNMENT
+
+
+def make_response(status_code, body=None):
+    """
+    Builds a mocked requests response with the given status and JSON body
+    """
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = body or {}
+    return response
+
+
+def make_batch_response(sub_responses):
+    """
+    Builds a mocked $batch response carrying the given sub-responses
+    """
+    response = mock.Mock(status_code=200)
+    response.content = json.dumps({'responses': sub_responses}).encode()
+    return response
+
+
+def make_library():
+    """
+    Builds a DocumentLibrary with placeholder configuration
+    """
+    return DocumentLibrary('client', 'site', 'res', 'authority', 'scope')
+
+
+def sent_ranges(session):
+    """
+    Gets the Content-Range header of each PUT issued through a mocked session
+    """
+    return [call.kwargs['headers']['Content-Range'] for call in session.put.call_args_list]
+
+
+class UploadTests(unittest.TestCase):
+    """
+    Tests for SimpleETL.upload and its chunked upload session handling
+    """
+    def setUp(self):
+        self.etl = SimpleETL(make_library(), 'thumbprint', 'private key', token_cache_path=None)
+        self.etl._transfer_session = mock.Mock()
+
+
+    def upload_chunks(self, data):
+        """
+        Sends data through the private chunked upload loop in CHUNK sized ranges
+        """
+        # pylint: disable=protected-access
+        self.etl._SimpleETL__upload_chunks('https://upload', io.BytesIO(data), len(data), CHUNK)
+
+
+    def test_upload_chunks_follows_next_expected_ranges(self):
+        size = 2 * CHUNK + 10
+        self.etl._transfer_session.put.side_effect = [
+            make_response(202, {'nextExpectedRanges': [f'{CHUNK}-']}),
+            make_response(202, {'nextExpectedRanges': [f'{2 * CHUNK}-']}),
+            make_response(201),
+        ]
+
+        self.upload_chunks(b'x' * size)
+
+        self.assertEqual(sent_ranges(self.etl._transfer_session), [
+            f'bytes 0-{CHUNK - 1}/{size}',
+            f'bytes {CHUNK}-{2 * CHUNK - 1}/{size}',
+            f'bytes {2 * CHUNK}-{size - 1}/{size}',
+        ])
+
+
+    def test_upload_chunks_resumes_after_range_not_satisfiable(self):
+        size = 2 * CHUNK
+        self.etl._transfer_session.put.side_effect = [
+            make_response(202, {'nextExpectedRanges': [f'{CHUNK}-']}),
+            make_response(416),
+            make_response(201),
+        ]
+        self.etl._transfer_session.get.return_value = make_response(
+            200, {'nextExpectedRanges': [f'{CHUNK}-{size - 1}']})
+
+        self.upload_chunks(b'x' * size)
+
+        self.etl._transfer_session.get.assert_called_once_with('https://upload')
+        self.assertEqual(sent_ranges(self.etl._transfer_session), [
+            f'bytes 0-{CHUNK - 1}/{size}',
+            f'bytes {CHUNK}-{size - 1}/{size}',
+            f'bytes {CHUNK}-{size - 1}/{size}',
+        ])
+
+
+    def test_upload_chunks_raises_when_resumes_are_exhausted(self):
+        self.etl._transfer_session.put.return_value = make_response(409)
+        self.etl._transfer_session.get.return_value = make_response(
+            200, {'nextExpectedRanges': ['0-']})
+
+        with self.assertRaises(Exception):
+            self.upload_chunks(b'x' * CHUNK)
+
+
+    def test_upload_chunks_raises_when_accepted_ranges_stop_advancing(self):
+        self.etl._transfer_session.put.return_value = make_response(
+            202, {'nextExpectedRanges': ['0-']})
+
+        with self.assertRaises(Exception):
+            self.upload_chunks(b'x' * 2 * CHUNK)
+        self.assertEqual(self.etl._transfer_session.put.call_count, UPLOAD_MAX_RESUMES + 1)
+
+
+    def test_upload_empty_file_puts_content_directly(self):
+        api_session = mock.Mock()
+        api_session.put.return_value = make_response(201)
+
+        with tempfile.TemporaryDirectory() as local_path, \
+                mock.patch.object(SimpleETL, '_session', new_callable=mock.PropertyMock,
+                    return_value=api_session):
+            open(os.path.join(local_path, 'empty.txt'), 'wb').close()
+            self.etl.upload('empty.txt', 'remote/dir', local_path)
+
+        api_session.post.assert_not_called()
+        api_session.put.assert_called_once()
+        self.assertTrue(api_session.put.call_args.args[0].endswith(
+            '/root:/remote/dir/empty.txt:/content'))
+        self.etl._transfer_session.put.assert_not_called()
+
+
+    def test_upload_empty_file_raises_on_bad_response(self):
+        api_session = mock.Mock()
+        api_session.put.return_value = make_response(500)
+
+        with tempfile.TemporaryDirectory() as local_path, \
+                mock.patch.object(SimpleETL, '_session', new_callable=mock.PropertyMock,
+                    return_value=api_session):
+            open(os.path.join(local_path, 'empty.txt'), 'wb').close()
+            with self.assertRaises(Exception):
+                self.etl.upload('empty.txt', 'remote/dir', local_path)
+
+
+class BatchTests(unittest.TestCase):
+    """
+    Tests for batched deletes and listings through the $batch endpoint, and the cached
+    directory listings deletes resolve item IDs from
+    """
+    def setUp(self):
+        self.etl = SimpleETL(make_library(), 'thumbprint', 'private key', token_cache_path=None)
+        self.api_session = mock.Mock()
+        patcher = mock.patch.object(SimpleETL, '_session', new_callable=mock.PropertyMock,
+            return_value=self.api_session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sleep_patcher = mock.patch('simple_graph_etl.simpleetl.time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+
+    def list_files(self, count):
+        """
+        Makes the children listing return count files named f0..fN with IDs i0..iN
+        """
+        self.api_session.get.return_value = make_response(200)
+        self.api_session.get.return_value.content = json.dumps({'value': [
+            {'id': f'i{n}', 'name': f'f{n}'} for n in range(count)]}).encode()
+
+
+    def test_delete_many_splits_into_batches_of_batch_limit(self):
+        count = 2 * BATCH_LIMIT + 5
+        self.list_files(count)
+        self.api_session.post.side_effect = lambda url, json: make_batch_response(
+            [{'id': sub['id'], 'status': 204} for sub in reversed(json['requests'])])
+
+        self.etl.delete_many('dir', [f'f{n}' for n in range(count)])
+
+        sizes = [len(call.kwargs['json']['requests'])
+            for call in self.api_session.post.call_args_list]
+        self.assertEqual(sizes, [BATCH_LIMIT, BATCH_LIMIT, 5])
+        urls = [sub['url'] for call in self.api_session.post.call_args_list
+            for sub in call.kwargs['json']['requests']]
+        self.assertEqual(urls, [f'/sites/site/drives/res/items/i{n}' for n in range(count)])
+
+
+    def test_filenames_many_orders_responses_by_id(self):
+        self.api_session.post.return_value = make_batch_response([
+            {'id': '1', 'status': 200, 'body': {'value': [{'name': 'b', 'file': {'x': 1}}]}},
+            {'id': '0', 'status': 200, 'body': {'value': [{'name': 'a', 'file': {'x': 1}}]}},
+        ])
+
+        self.assertEqual(self.etl.filenames_many(['one', 'two']), {'one': ['a'], 'two': ['b']})
+
+
+    def test_delete_retries_throttled_sub_requests(self):
+        self.list_files(1)
+        self.api_session.post.side_effect = [
+            make_batch_response([{'id': '0', 'status': 429, 'headers': {'retry-after': '7'}}]),
+            make_batch_response([{'id': '0', 'status': 204}]),
+        ]
+
+        self.etl.delete('dir', 'f0')
+
+        self.assertEqual(self.api_session.post.call_count, 2)
+        self.sleep.assert_called_once_with(7.0)
+
+
+    def test_delete_raises_once_retries_are_exhausted(self):
+        self.list_files(1)
+        self.api_session.post.side_effect = lambda url, json: make_batch_response(
+            [{'id': '0', 'status': 503}])
+
+        with self.assertRaises(Exception):
+            self.etl.delete('dir', 'f0')
+        self.assertEqual(self.api_session.post.call_count, RETRY_TOTAL + 1)
+
+
+    def test_deletes_in_one_directory_share_a_listing(self):
+        self.list_files(2)
+        self.api_session.post.side_effect = lambda url, json: make_batch_response(
+            [{'id': sub['id'], 'status': 204} for sub in json['requests']])
+
+        self.etl.delete('dir', 'f0')
+        self.etl.delete('dir', 'f1')
+
+        self.assertEqual(self.api_session.get.call_count, 1)
+        with self.assertRaises(Exception):
+            self.etl.delete('dir', 'f0')
+        self.assertEqual(self.api_session.get.call_count, 1)
+
+
+    def test_failed_delete_invalidates_listing(self):
+        self.list_files(2)
+        self.api_session.post.side_effect = [
+            make_batch_response([{'id': '0', 'status': 403}]),
+            make_batch_response([{'id': '0', 'status': 204}]),
+        ]
+
+        with self.assertRaises(Exception):
+            self.etl.delete('dir', 'f0')
+        self.etl.delete('dir', 'f1')
+
+        self.assertEqual(self.api_session.get.call_count, 2)
+
+
+    def test_upload_invalidates_listing(self):
+        self.list_files(1)
+        self.api_session.post.side_effect = [
+            make_batch_response([{'id': '0', 'status': 204}]),
+            make_response(200, {'uploadUrl': 'https://upload'}),
+            make_batch_response([{'id': '0', 'status': 204}]),
+        ]
+        self.etl._transfer_session = mock.Mock()
+        self.etl._transfer_session.put.return_value = make_response(201)
+
+        self.etl.delete('dir', 'f0')
+        with tempfile.TemporaryDirectory() as local_path:
+            with open(os.path.join(local_path, 'f0'), 'wb') as file:
+                file.write(b'data')
+            self.etl.upload('f0', 'dir', local_path)
+        self.etl.delete('dir', 'f0')
+
+        self.assertEqual(self.api_session.get.call_count, 2)
+
+
+class FakeConfidentialClientApplication:
+    """
+    Stands in for msal.ConfidentialClientApplication, issuing numbered tokens and recording
+    the token cache it was given
+    """
+    issued = 0
+    loaded_cache = None
+
+    def __init__(self, client_id, authority, client_credential, token_cache):
+        self.token_cache = token_cache
+        FakeConfidentialClientApplication.loaded_cache = json.loads(token_cache.serialize())
+
+
+    def acquire_token_silent(self, scopes, account):
+        return None
+
+
+    def acquire_token_for_client(self, scopes):
+        FakeConfidentialClientApplication.issued += 1
+        self.token_cache.deserialize(json.dumps({'AccessToken': {'key': {'secret': 'cached'}}}))
+        self.token_cache.has_state_changed = True
+        return {'access_token': f'token{self.issued}', 'expires_in': TOKEN_REFRESH_MARGIN + 60}
+
+
+class TokenTests(unittest.TestCase):
+    """
+    Tests for lazy token acquisition, refresh and best-effort cache persistence
+    """
+    def setUp(self):
+        FakeConfidentialClientApplication.issued = 0
+        FakeConfidentialClientApplication.loaded_cache = None
+        patcher = mock.patch('simple_graph_etl.tokenprovider.msal.ConfidentialClientApplication',
+            FakeConfidentialClientApplication)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.cache_path = os.path.join(self.cache_dir.name, 'nested', 'token.bin')
+
+
+    def test_token_is_acquired_on_first_api_use(self):
+        etl = SimpleETL(make_library(), 'thumbprint', 'private key')
+        self.assertEqual(FakeConfidentialClientApplication.issued, 0)
+
+        self.assertEqual(etl._session.headers['Authorization'], 'Bearer token1')
+        self.assertEqual(etl._session.headers['Authorization'], 'Bearer token1')
+        self.assertEqual(FakeConfidentialClientApplication.issued, 1)
+
+
+    def test_token_is_reacquired_within_refresh_margin(self):
+        provider = TokenProvider(make_library(), 'thumbprint', 'private key')
+        with mock.patch('simple_graph_etl.tokenprovider.time.monotonic', return_value=1000.0):
+            self.assertEqual(provider.get_token(), 'token1')
+        with mock.patch('simple_graph_etl.tokenprovider.time.monotonic', return_value=1059.0):
+            self.assertEqual(provider.get_token(), 'token1')
+        with mock.patch('simple_graph_etl.tokenprovider.time.monotonic', return_value=1060.0):
+            self.assertEqual(provider.get_token(), 'token2')
+
+
+    def test_token_cache_round_trips_through_disk(self):
+        TokenProvider(make_library(), 'thumbprint', 'private key', self.cache_path).get_token()
+        self.assertEqual(os.stat(self.cache_path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_path)), ['token.bin'])
+
+        TokenProvider(make_library(), 'thumbprint', 'private key', self.cache_path).get_token()
+        self.assertEqual(FakeConfidentialClientApplication.loaded_cache['AccessToken'],
+            {'key': {'secret': 'cached'}})
+
+
+    def test_unwritable_token_cache_is_ignored(self):
+        provider = TokenProvider(make_library(), 'thumbprint', 'private key',
+            '/proc/nope/token.bin')
+        self.assertEqual(provider.get_token(), 'token1')
+
+
+    def test_corrupt_token_cache_is_ignored(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write('not json')
+
+        provider = TokenProvider(make_library(), 'thumbprint', 'private key', self.cache_path)
+        self.assertEqual(provider.get_token(), 'token1')
+
+
+class FakeAsyncResponse:
+    """
+    Stands in for aiohttp.ClientResponse with a fixed status, headers and JSON body
+    """
+    def __init__(self, status, body=None, headers=None, data=b''):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body or {}
+        self.content = mock.Mock()
+        self.content.iter_chunked = lambda size: self.__iter_data(data)
+
+
+    @staticmethod
+    async def __iter_data(data):
+        yield data
+
+
+    async def json(self):
+        return self.body
+
+
+    def release(self):
+        pass
+
+
+class FakeAsyncSession:
+    """
+    Stands in for aiohttp.ClientSession, answering each request through a handler and
+    recording (method, url, headers) for every call
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+
+
+    async def request(self, method, url, headers=None, **kwargs):
+        self.calls.append((method, url, headers))
+        return await self.handler(method, url, headers=headers, **kwargs)
+
+
+def respond_in_order(*responses):
+    """
+    Builds a request handler that answers calls with responses in order
+    """
+    pending = list(responses)
+
+    async def handler(method, url, **kwargs):
+        return pending.pop(0)
+    return handler
+
+
+@unittest.skipIf(AsyncSimpleETL is None, 'aiohttp and aiofiles are not installed')
+class AsyncTests(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests for AsyncSimpleETL retries, fetch cancellation and chunked uploads against a
+    mocked session
+    """
+    def setUp(self):
+        self.etl = AsyncSimpleETL(make_library(), 'thumbprint', 'private key')
+        token_patcher = mock.patch.object(TokenProvider, 'get_token', return_value='token')
+        token_patcher.start()
+        self.addCleanup(token_patcher.stop)
+        sleep_patcher = mock.patch('simple_graph_etl.asyncsimpleetl.asyncio.sleep',
+            new_callable=mock.AsyncMock)
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        self.local_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.local_dir.cleanup)
+
+
+    def use_session(self, handler):
+        """
+        Routes the client's requests through a FakeAsyncSession using handler
+        """
+        self.session = FakeAsyncSession(handler)
+        # pylint: disable=protected-access
+        self.etl._AsyncSimpleETL__get_session = lambda: self.session
+
+
+    async def test_request_waits_for_retry_after(self):
+        self.use_session(respond_in_order(
+            FakeAsyncResponse(429, headers={'Retry-After': '3'}),
+            FakeAsyncResponse(200, {'value': [{'name': 'a', 'file': {'x': 1}}]})))
+
+        self.assertEqual(await self.etl.filenames('dir'), ['a'])
+        self.sleep.assert_awaited_once_with(3.0)
+        self.assertEqual(self.session.calls[1][2], {'Authorization': 'Bearer token'})
+
+
+    async def test_request_backs_off_until_retries_are_exhausted(self):
+        self.use_session(respond_in_order(*[FakeAsyncResponse(503)] * (RETRY_TOTAL + 1)))
+
+        with self.assertRaises(Exception):
+            await self.etl.filenames('dir')
+        self.assertEqual(len(self.session.calls), RETRY_TOTAL + 1)
+        self.assertEqual([call.args[0] for call in self.sleep.await_args_list],
+            [RETRY_BACKOFF_FACTOR * 2 ** attempt for attempt in range(RETRY_TOTAL)])
+
+
+    async def test_request_does_not_retry_post(self):
+        self.use_session(respond_in_order(FakeAsyncResponse(503)))
+        with open(os.path.join(self.local_dir.name, 'file'), 'wb') as file:
+            file.write(b'data')
+
+        with self.assertRaises(Exception):
+            await self.etl.upload('file', 'dir', self.local_dir.name)
+        self.assertEqual(len(self.session.calls), 1)
+
+
+    async def test_fetch_cancels_sibling_downloads_on_failure(self):
+        cancelled = []
+        never = asyncio.Event()
+
+        async def handler(method, url, **kwargs):
+            if 'children' in url:
+                return FakeAsyncResponse(200, {'value': [
+                    {'name': name, 'file': {'x': 1}, '@microsoft.graph.downloadUrl': name}
+                    for name in ('bad', 'slow1', 'slow2')]})
+            if url == 'bad':
+                return FakeAsyncResponse(404)
+            try:
+                await never.wait()
+            except asyncio.CancelledError:
+                cancelled.append(url)
+                raise
+        self.use_session(handler)
+
+        with self.assertRaises(Exception):
+            await self.etl.fetch('dir', self.local_dir.name)
+        self.assertEqual(sorted(cancelled), ['slow1', 'slow2'])
+
+
+    async def test_upload_follows_ranges_and_resumes(self):
+        size = 2 * CHUNK + 10
+        with open(os.path.join(self.local_dir.name, 'file'), 'wb') as file:
+            file.write(b'x' * size)
+        self.use_session(respond_in_order(
+            FakeAsyncResponse(200, {'uploadUrl': 'https://upload'}),
+            FakeAsyncResponse(202, {'nextExpectedRanges': [f'{CHUNK}-']}),
+            FakeAsyncResponse(416),
+            FakeAsyncResponse(200, {'nextExpectedRanges': [f'{CHUNK}-']}),
+            FakeAsyncResponse(202, {'nextExpectedRanges': [f'{2 * CHUNK}-']}),
+            FakeAsyncResponse(201)))
+        put_headers = []
+        handler = self.session.handler
+
+        async def recording_handler(method, url, headers=None, **kwargs):
+            if method == 'PUT':
+                put_headers.append(headers['Content-Range'])
+            return await handler(method, url, headers=headers, **kwargs)
+        self.session.handler = recording_handler
+
+        await self.etl.upload('file', 'dir', self.local_dir.name, chunk_size=CHUNK)
+
+        self.assertEqual(put_headers, [
+            f'bytes 0-{CHUNK - 1}/{size}',
+            f'bytes {CHUNK}-{2 * CHUNK - 1}/{size}',
+            f'bytes {CHUNK}-{2 * CHUNK - 1}/{size}',
+            f'bytes {2 * CHUNK}-{size - 1}/{size}',
+        ])
+
+
+    async def test_upload_raises_when_accepted_ranges_stop_advancing(self):
+        with open(os.path.join(self.local_dir.name, 'file'), 'wb') as file:
+            file.write(b'x' * CHUNK)
+        self.use_session(respond_in_order(
+            FakeAsyncResponse(200, {'uploadUrl': 'https://upload'}),
+            *[FakeAsyncResponse(202, {'nextExpectedRanges': ['0-']})] * (UPLOAD_MAX_RESUMES + 1)))
+
+        with self.assertRaises(Exception):
+            await self.etl.upload('file', 'dir', self.local_dir.name, chunk_size=CHUNK)
+
+
+    async def test_upload_empty_file_puts_content_directly(self):
+        open(os.path.join(self.local_dir.name, 'empty'), 'wb').close()
+        self.use_session(respond_in_order(FakeAsyncResponse(201)))
+
+        await self.etl.upload('empty', 'dir', self.local_dir.name)
+
+        self.assertEqual(len(self.session.calls), 1)
+        method, url, _ = self.session.calls[0]
+        self.assertEqual(method, 'PUT')
+        self.assertTrue(url.endswith('/dir/empty:/content'))
+
+
+if __name__ == '__main__':
+    unittest.main()